@@ -5,43 +5,77 @@ from pathlib import Path
 
 import matplotlib.pyplot as plt
 import pandas as pd
+import polars as pl
 import pytz
-import seaborn as sns
 
 # %% [markdown]
-# ## Gathering the data
+# ## Gathering the data
 #
 # Transport for London (TfL) offers an API that one can query to know the status of the London Cycle Network. A while ago I got curious about how the usage varies across the city troughout the day, so I wrote a script that creates a snapshot of the status roughly every 15 minutes. The following is an example of what can be done with these snapshots.
 
 # %% [markdown]
 # ## Load all the data
 #
-# The data for the cycles stations is split by days; I can use a *glob* pattern to read all of them into a list only to concatenate them into a single dataframe afterwards:
+# The data for the cycles stations is split by days, in CSV files. Parsing them every time I run this notebook is slow, so the first time around I convert each file into a *Parquet* file, a columnar format that keeps the types of the columns (including the fact that `query_time` is in UTC). I also give *polars* the type of every column, so it does not have to guess them, and use smaller types than the default ones: 32-bit floats are precise enough for the coordinates, and 16-bit integers are more than enough to count bikes and docks. A file only gets converted again if its CSV has changed since, or if it was stored with different types. The files with the stations information (`stations-*.csv`) have a different format, hence the `2*` in the pattern:
+
+# %% gist="cache_parquet.py"
+parquet_path = Path("parquet")
+parquet_path.mkdir(exist_ok=True)
+
+csv_schema = {
+    "query_time": pl.Datetime("us"),
+    "place_id": pl.String,
+    "lat": pl.Float32,
+    "lon": pl.Float32,
+    "bikes": pl.Int16,
+    "empty_docks": pl.Int16,
+    "docks": pl.Int16,
+}
+parquet_schema = {**csv_schema, "query_time": pl.Datetime("us", "UTC")}
+
+parquet_files = []
+for csv_file in sorted(Path("data").glob("2*.csv")):
+    parquet_file = parquet_path / f"{csv_file.stem}.parquet"
+    parquet_files.append(parquet_file)
+    if (
+        parquet_file.exists()
+        and parquet_file.stat().st_mtime >= csv_file.stat().st_mtime
+        and pl.read_parquet_schema(parquet_file) == parquet_schema
+    ):
+        continue
+    (
+        pl.read_csv(csv_file, schema=csv_schema)
+        .with_columns(pl.col("query_time").dt.replace_time_zone("UTC"))
+        .write_parquet(parquet_file, compression="zstd")
+    )
+
+# %% [markdown]
+# Then, *polars* can take the list of *Parquet* files and scan all of them as if they were a single one. I use the list built above rather than a *glob* pattern, so that a cached file whose CSV is gone does not sneak into the data. The scan is *lazy*, nothing is read until I ask for results with `.collect()`:
 
 # %% gist="read_frames.py" dataframe="initial_data.png"
-frames = []
-for csv_file in Path("data").glob("*.csv"):
-    df = pd.read_csv(csv_file, parse_dates=["query_time"])
-    frames.append(df)
-all_data = pd.concat(frames)
+all_data = pl.scan_parquet(parquet_files)
 
-all_data.sample(10, random_state=42)
+all_data.head(10).collect()
 
 # %% [markdown]
-# As you can see, due to the data collection process, the times are not evenly distributed. The following lines do two things:
+# As you can see, due to the data collection process, the times are not evenly distributed. The following lines do three things:
 #
-#  - Modifies the `query_time` column: The dataset dates are in UTC, but when read from using *pandas*, this information is not taken into account. With `dt.tz_localize("utc")`, I set UTC as the timezone, then with `dt.tz_convert("Europe/London")` I change them to the London timezone and with `dt.floor("15min")` I round (or floor) the times to the nearest 15 minute.
+#  - Modifies the `query_time` column: The dataset dates are in UTC, with `dt.convert_time_zone("Europe/London")` I change them to the London timezone and with `dt.truncate("15m")` I round (or floor) the times to the nearest 15 minute.
 #  - Calculates the `proportion`, a value ranging from 0 to 1 that summarises how empty or full the bike station is
+#  - Turns `place_id` into a `Categorical`: there are only a few hundred bike points, so rather than comparing and hashing their names over and over, *polars* can work with a small number that identifies each one of them. Each *Parquet* file gets cast separately, so I enable the global *string cache* first; that way the same bike point gets the same number in every file, and *polars* does not have to re-encode them when putting the files together
 
 # %% gist="transform_dataframe.py" dataframe="rounded.png"
 london_tz = pytz.timezone("Europe/London")
 
-all_data["query_time"] = pd.to_datetime(
-    all_data["query_time"].dt.tz_localize("utc").dt.tz_convert(london_tz).dt.floor("15min")
+pl.enable_string_cache()
+
+all_data = all_data.with_columns(
+    pl.col("query_time").dt.convert_time_zone("Europe/London").dt.truncate("15m"),
+    ((pl.col("docks") - pl.col("empty_docks")) / pl.col("docks")).alias("proportion"),
+    pl.col("place_id").cast(pl.Categorical),
 )
-all_data["proportion"] = (all_data["docks"] - all_data["empty_docks"]) / all_data["docks"]
 
-all_data.sample(10, random_state=42)
+all_data.head(10).collect()
 
 # %% [markdown]
 # And with that, data is evenly spaced and I now have a single column that tells how empty is a station at that specific point in time.
@@ -56,7 +90,7 @@ beginning = datetime.datetime(2022, 5, 7, tzinfo=london_tz)
 end = datetime.datetime(2022, 5, 14, tzinfo=london_tz)
 
 if beginning and end:
-    data_to_plot = all_data[(all_data["query_time"] >= beginning) & (all_data["query_time"] <= end)]
+    data_to_plot = all_data.filter(pl.col("query_time").is_between(beginning, end))
 else:
     data_to_plot = all_data
 
@@ -66,10 +100,10 @@ else:
 # Since the way I get the data is somewhat unreliable, I want to perform a quick check to see what the data looks like. A group by `query_time` should reveal any missing data:
 
 # %% gist="show_times.py" dataframe="show_missing_times.png"
-data_to_plot.groupby("query_time").count().head(5)
+data_to_plot.group_by("query_time").len().sort("query_time").head(8).collect()
 
 # %% [markdown]
-# And there it is, see the jumps between the first and second row? It goes from `01:15:00` to `01:45:00`, and from the second to the third row there is almost an hour of missing data!
+# And there it is, see the jumps in the last rows? It goes from `01:15:00` to `01:45:00`, and from there to `02:30:00`, there is almost an hour of missing data!
 #
 # There is a way to fix this problem... or at least make it less bad.
 
@@ -79,77 +113,59 @@ data_to_plot.groupby("query_time").count().head(5)
 # I need to do a bit of resampling to get this to work as I want it to. Let's start small, with a single bike point.
 
 # %% gist="select_single.py" dataframe="single_bikepoint.png"
-bikepoint = data_to_plot[data_to_plot["place_id"] == "BikePoints_87"]
-bikepoint_resampled = bikepoint.copy()
+bikepoint = data_to_plot.filter(pl.col("place_id") == "BikePoints_87").collect()
 bikepoint.head()
 
 # %% [markdown]
-# In order to use *pandas*'s resampling utilities, I need to set a time index in our dataframe; in this case, `query_time` will be my time index:
+# *polars* does not have an index; to resample, I can use `.group_by_dynamic`, which groups the rows in time windows over a sorted column, `query_time` in this case. I want 15-minute windows, hence `every="15m"`, and I need to specify what to do with the values in each window, I can use `.median()` to achieve my goal:
 
-# %% gist="set_index.py" dataframe="resampled.png"
-bikepoint_resampled = bikepoint_resampled.set_index("query_time")
+# %% gist="group_by_dynamic.py" dataframe="resampled_to_15.png"
+bikepoint_resampled = (
+    bikepoint.sort("query_time").group_by_dynamic("query_time", every="15m").agg(pl.exclude("place_id").median())
+)
 bikepoint_resampled.head()
 
 # %% [markdown]
-# Then I can use `.resample` passing on the value `"15min"` since I want 15-minute intervals. But what resample returns is still not what I am after, I need to specify what to do with the newly resampled times that do not have a value assigned to them, I can use `.median()` to achieve my goal:
+# But `.group_by_dynamic` only returns the windows that have data in them; with `.upsample` I can add the missing 15-minute intervals:
 
-# %% gist="resampled_to_15minutes.py" dataframe="resampled_to_15.png"
-bikepoint_resampled = bikepoint_resampled.resample("15min").median()
-bikepoint_resampled.head()
+# %% gist="upsample.py" dataframe="upsampled.png"
+bikepoint_resampled = bikepoint_resampled.upsample("query_time", every="15m")
+bikepoint_resampled.slice(4, 6)
 
 # %% [markdown]
-# Now it is possible to see the gaps; in the previous dataframe, the second, fourth and fifth rows were missing, and now they appear but have no value; I will take care of that next with the `.interpolate` method for data frames.
+# Now it is possible to see the gaps; the windows at `01:30`, `02:00` and `02:15` had no data, so `.group_by_dynamic` skipped them, and now they appear but have no value; I will take care of that next with the `.interpolate` method for data frames.
 #
 # The `.interpolate` method allows us to specify how we want this interpolation to happen via the `method` argument, it defaults to `linear`, which is something I can work with for the purposes of this post, but if you have other requirements, make sure you use the proper method.
 
 # %% gist="interpolated_data.py" dataframe="interpolated.png"
 bikepoint_resampled = bikepoint_resampled.interpolate()
-bikepoint_resampled.head()
-
-# %% [markdown]
-# Finally, we can reset the index to return our `query_time` to the dataframe columns:
-
-# %% gist="reset_index.py" dataframe="reset_index.png"
-bikepoint_resampled = bikepoint_resampled.reset_index()
-bikepoint_resampled.head()
+bikepoint_resampled.slice(4, 6)
 
 
 # %% [markdown]
 # Did you notice it? We lost the bike point the dataframe refers to throughout all our transformations! Nothing to worry about since we know it is the `BikePoint_87`, but we need to be careful when applying these transformations to the whole dataset.
 
 # %% [markdown]
-# And to apply those transformations to the whole dataset, the only thing that came to my mind was to create a function that does everything we have been discussing so far:
-
-# %% gist="interpolate_function.py"
-def interpolate_bikepoint(dataframe):
-    resampled = dataframe.copy()
-    resampled = resampled.set_index("query_time")
-    resampled = resampled.resample("15min").median()
-    resampled = resampled.interpolate()
-    return resampled.reset_index()
-
-
-# %% [markdown]
-# And apply it to subsets (one *bikepoint* per subset) of our big dataframe while keeping track of the corresponding *bikepoint*:
-
-# %% gist="interpolate_point_by_point.py" dataframe="all_interpolated.png"
-all_bikepoints = data_to_plot["place_id"].unique()
-
-resampled_frames = []
-
-for bikepoint in all_bikepoints:
-    resampled = interpolate_bikepoint(data_to_plot[data_to_plot["place_id"] == bikepoint])
-    resampled["place_id"] = bikepoint
-    resampled_frames.append(resampled)
-
-data_to_plot = pd.concat(resampled_frames)
+# And to apply those transformations to the whole dataset, there is no need to go *bikepoint* by *bikepoint*: both `.group_by_dynamic` and `.upsample` take a `group_by` argument, so every *bikepoint* gets resampled in a single pass.
+#
+# The rows added by `.upsample` do not have a `place_id`; since the rows are still sorted by *bikepoint*, I can fill it with the previous value. The interpolation can run over the whole dataframe at once, without mixing values from different *bikepoints*: the rows of each *bikepoint* start and end with a window that has data, so every gap is surrounded by values of its own *bikepoint*:
+
+# %% gist="interpolate_all_bikepoints.py" dataframe="all_interpolated.png"
+data_to_plot = (
+    data_to_plot.sort("place_id", "query_time")
+    .group_by_dynamic("query_time", every="15m", group_by="place_id")
+    .agg(pl.exclude("place_id").median())
+    .collect()
+    .upsample("query_time", every="15m", group_by="place_id", maintain_order=True)
+    .with_columns(pl.col("place_id").forward_fill(), pl.exclude("place_id", "query_time").interpolate())
+)
 data_to_plot.head()
 
 # %% [markdown]
 # We can check that there are no more gaps:
 
 # %% gist="no_more_gaps.py" dataframe="gapless.png"
-data_to_plot.groupby("query_time").count().head(5)
+data_to_plot.group_by("query_time").len().sort("query_time").head(8)
 
 # %% [markdown]
 # ## Making the plot geographically realistic
@@ -159,7 +175,7 @@ data_to_plot.groupby("query_time").count().head(5)
 # I discovered some neat packages in the process:
 #
 #  - [Astral](https://github.com/sffjunkie/astral) provides calculations of the sun and moon position. I will be using this to know when the sunrise and sunset are happening in London.
-#  - [Colour](https://github.com/vaab/colour) to manipulate colours. I will be using this package to create nice transitions between different colours.
+#  - [Colour](https://github.com/vaab/colour) to manipulate colours. I will be using this package to read and write colours, while *numpy* creates the transitions between them.
 #
 #  I will not spend too much time explaining the functions; please refer to the documentation, read the inline comments or reach out to me for further clarification.
 
@@ -167,9 +183,10 @@ data_to_plot.groupby("query_time").count().head(5)
 from astral import LocationInfo
 from astral.sun import sun
 
+london = LocationInfo("London", "England", "Europe/London", 51.507351, -0.127758)
+
 
 def get_sun_intervals(date):
-    london = LocationInfo("London", "England", "Europe/London", 51.507351, -0.127758)
     sun_over_london = sun(london.observer, date=date)
 
     return [
@@ -185,7 +202,9 @@ def get_sun_intervals(date):
 
 # %% gist="get_colors_by_time.py"
 import math
+from functools import lru_cache
 
+import numpy as np
 import pytz
 from colour import Color
 
@@ -193,7 +212,13 @@ utc = pytz.timezone("UTC")
 
 
 def get_colors_by_time(date):
-    date = date.replace(minute=0, hour=0, second=0, microsecond=0, tzinfo=london_tz)
+    # The gradient only depends on the day, every time of the same day shares it
+    return get_colors_by_day(date.date())
+
+
+@lru_cache(maxsize=None)
+def get_colors_by_day(day):
+    date = london_tz.localize(datetime.datetime.combine(day, datetime.time()))
     sun_intervals = get_sun_intervals(date)
 
     # Calculate the time between sun positions in seconds
@@ -204,24 +229,23 @@ def get_colors_by_time(date):
     night = Color("#7f7f7f")
     mid = Color("#a2a2a2")
     noon = Color("#c7c7c7")
+    palette = np.array([color.rgb for color in [darkness, night, mid, noon, mid, night, darkness]])
 
-    # Create an array of colours going from darkness to noon to darkness,
+    # Create an array of RGB values going from darkness to noon to darkness,
     # taking into consideration the minutes it takes to go from one state to the other
-    colors = []
-    colors.extend(darkness.range_to(night, minutes[0]))
-    colors.extend(night.range_to(mid, minutes[1]))
-    colors.extend(mid.range_to(noon, minutes[2]))
-    colors.extend(noon.range_to(mid, minutes[3]))
-    colors.extend(mid.range_to(night, minutes[4]))
-    colors.extend(night.range_to(darkness, minutes[5]))
+    colors = np.concatenate(
+        [np.linspace(start, end, num) for start, end, num in zip(palette[:-1], palette[1:], minutes)]
+    )
 
     # Sample the array every 15 minutes to return a dictionary where the time is the key and the color is the value
-    every_15_minutes = {date + datetime.timedelta(minutes=idx): colors[idx].hex for idx in range(0, 1441, 15)}
+    every_15_minutes = {
+        date + datetime.timedelta(minutes=idx): Color(rgb=tuple(colors[idx])).hex for idx in range(0, 1441, 15)
+    }
     return every_15_minutes
 
 
 # %% [markdown]
-# Together, the above functions allow me to get a colour gradient for a specific date. For example, to check today's gradient, we can do the following:
+# Together, the above functions allow me to get a colour gradient for a specific date. Calculating a gradient is not cheap, and every time of the same day gets the same one, so `get_colors_by_day` is wrapped in `lru_cache` to calculate it only once per day. For example, to check today's gradient, we can do the following:
 
 # %% gist="print_gradients.py"
 today = datetime.datetime.today()
@@ -266,21 +290,28 @@ fig.tight_layout()
 # %% [markdown]
 # #### Zooming in
 #
-# The function `prepare_axes` adjusts the "view" for the plot, centring it on the actual bicycle stations.
+# The function `prepare_axes` adjusts the "view" for the plot, centring it on the actual bicycle stations. The stations do not move, so their boundaries are calculated only once, with `get_bounds`, and used for every plot.
 
 # %% gist="prepare_axes.py"
 PADDING = 0.005
 
 
-def prepare_axes(ax: plt.Axes, cycles_info: pd.DataFrame):
+def get_bounds(cycles_info):
     min_y = cycles_info["lat"].min() - PADDING
     max_y = cycles_info["lat"].max() + PADDING
     min_x = cycles_info["lon"].min() - PADDING
     max_x = cycles_info["lon"].max() + PADDING
+    return min_x, max_x, min_y, max_y
+
+
+def prepare_axes(ax: plt.Axes, bounds):
+    min_x, max_x, min_y, max_y = bounds
     ax.set_ylim((min_y, max_y))
     ax.set_xlim((min_x, max_x))
     ax.set_axis_off()
-    return min_x, max_x, min_y, max_y
+
+
+map_bounds = get_bounds(data_to_plot)
 
 
 # %% [markdown]
@@ -327,35 +358,57 @@ def set_custom_legend(ax: plt.Axes, cmap: Colormap):
 # %% [markdown]
 # #### The actual map
 #
-# The function `plot_map` uses the previous two functions to actually plot the bike stations and the outline of the London boroughs.
+# The function `plot_map` uses the previous two functions to actually plot the bike stations and the outline of the London boroughs. The outline is the same for every frame, so the shapefile is read only once, outside of the function.
+#
+# Everything but the bike stations is drawn by `plot_background`; this will come in handy when creating the animation, as the background barely changes from one frame to the next. It returns the outline of the boroughs, so that its colour can be changed later on. The bike stations are drawn by `plot_stations` with a plain `ax.scatter`, coloured by their `proportion`; `Normalize(0, 1)` keeps the colours in line with the legend, whatever the values in the plot.
 
 # %% gist="plot_map.py"
 import geopandas as gpd
 
+london_map = gpd.read_file("shapefiles/London_Borough_Excluding_MHW.shp").to_crs(epsg=4326)
+cmap = plt.get_cmap("OrRd")
+norm = plt.Normalize(0, 1)
 
-def plot_map(ax, cycles_info, map_color):
-    # Calculate & set map boundaries
-    min_x, max_x, min_y, max_y = prepare_axes(ax, cycles_info)
 
-    # Get external resources
-    cmap = plt.get_cmap("OrRd")
-    london_map = gpd.read_file("shapefiles/London_Borough_Excluding_MHW.shp").to_crs(epsg=4326)
+def plot_background(ax, map_color):
+    # Set map boundaries
+    min_x, max_x, min_y, max_y = map_bounds
+    prepare_axes(ax, map_bounds)
 
     # Plot elements
     ax.fill_between([min_x, max_x], min_y, max_y, color="#9CC0F9")
     london_map.plot(ax=ax, linewidth=0.5, color=map_color, edgecolor="black")
-    sns.scatterplot(
-        y="lat", x="lon", hue="proportion", edgecolor="k", linewidth=0.4, palette=cmap, data=cycles_info, s=25, ax=ax
-    )
+    # geopandas draws all the boroughs as a single collection, the last one added to the axes
+    boroughs = ax.collections[-1]
     set_custom_legend(ax, cmap)
 
+    return boroughs
+
+
+def plot_stations(ax, cycles_info):
+    return ax.scatter(
+        cycles_info["lon"],
+        cycles_info["lat"],
+        c=cycles_info["proportion"],
+        s=25,
+        cmap=cmap,
+        norm=norm,
+        edgecolor="k",
+        linewidth=0.4,
+    )
+
+
+def plot_map(ax, cycles_info, map_color):
+    plot_background(ax, map_color)
+    plot_stations(ax, cycles_info)
+
 
 # %% [markdown]
 # #### A clock?
 #
 # Aside from my whole "let's make day and night happen", I think it is good to provide people with a visual reference of the actual time of day.
 #
-# The following snippet adds a patch in the plot with the time of the day. I wanted to add a nice touch by using a custom font via *matplotlib*'s `font_manager`; you can see that there are some *hardcoded* values to position the patch, but aside from that, the rest is standard *matplotlib* code.
+# The following snippet adds a patch in the plot with the time of the day. I wanted to add a nice touch by using a custom font via *matplotlib*'s `font_manager`; you can see that there are some *hardcoded* values to position the patch, but aside from that, the rest is standard *matplotlib* code. The function returns the two pieces of text, so that they can be updated later on.
 
 # %% gist="plot_clock.py"
 import matplotlib.patches as patches
@@ -364,9 +417,12 @@ from matplotlib import font_manager as fm
 roboto_mono = fm.FontProperties(fname="Roboto_Mono/RobotoMono-Italic-VariableFont_wght.ttf", size=30)
 
 
+def get_clock_texts(time_of_day):
+    return time_of_day.strftime("%A, %d %B").upper(), time_of_day.strftime("%H:%M")
+
+
 def plot_clock(axes, time_of_day):
-    text_year = time_of_day.strftime("%A, %d %B").upper()
-    text_time = time_of_day.strftime("%H:%M")
+    text_year, text_time = get_clock_texts(time_of_day)
     clock_center = (-0.063368, 51.4845)
     width = 0.04 / 2
     height = 0.011 / 2
@@ -379,8 +435,14 @@ def plot_clock(axes, time_of_day):
         facecolor="#F4F6F7",
     )
     axes.add_patch(rect)
-    axes.text(clock_center[0], clock_center[1] + 0.0025, text_year, fontsize=6, ha="center", fontproperties=roboto_mono)
-    axes.text(clock_center[0], clock_center[1] - 0.004, text_time, fontsize=20, ha="center", fontproperties=roboto_mono)
+    year_artist = axes.text(
+        clock_center[0], clock_center[1] + 0.0025, text_year, fontsize=6, ha="center", fontproperties=roboto_mono
+    )
+    time_artist = axes.text(
+        clock_center[0], clock_center[1] - 0.004, text_time, fontsize=20, ha="center", fontproperties=roboto_mono
+    )
+
+    return year_artist, time_artist
 
 
 # %% [markdown]
@@ -409,7 +471,7 @@ def show_figure(figure):
 fig, ax = get_fig_and_ax()
 
 date_to_plot = datetime.datetime(2022, 4, 30, 13, 30, tzinfo=utc)
-temporary_data = all_data[all_data["query_time"] == date_to_plot]
+temporary_data = all_data.filter(pl.col("query_time").dt.convert_time_zone("UTC") == date_to_plot).collect().to_pandas()
 
 plot_map(ax, temporary_data, "#F4F6F7")
 plot_clock(ax, date_to_plot)
@@ -421,10 +483,16 @@ show_figure(fig)
 #
 # Animations with *matplotlib* are... weird.
 #
-# To begin with, since I want to animate a timelapse, one frame for each unique time available in my dataset, I will create an array named `times` with each unique time in my dataset; I am turning these times to datetimes and making sure all of them are UTC too:
+# To begin with, *geopandas* and *matplotlib* work with *pandas* dataframes, so I am converting `data_to_plot` with `.to_pandas()`; the times in `query_time` keep their London timezone in the conversion.
+#
+# Each frame needs the rows for a single time; rather than filtering the whole dataframe once per frame, I split it by `query_time` just once, into a dictionary named `data_by_time`. Then, since I want to animate a timelapse, one frame for each unique time available in my dataset, I will create an array named `times` with the sorted keys of that dictionary:
 
 # %% gist="times_array.py"
-times = [pd.to_datetime(time).replace(tzinfo=london_tz) for time in sorted(data_to_plot["query_time"].unique())]
+data_to_plot = data_to_plot.to_pandas()
+
+data_by_time = dict(list(data_to_plot.groupby("query_time", sort=False)))
+
+times = sorted(data_by_time)
 
 print(times[0], times[-1])
 
@@ -437,7 +505,7 @@ print(times[0], times[-1])
 # The function does the following:
 #
 #  1. Clear the axes using `cla`; this is important or otherwise our animation will get messy
-#  2. For each `step`, I am getting the corresponding date from the `times` array I created above.
+#  2. For each `step`, I am getting the corresponding date from the `times` array I created above, and its data from `data_by_time`.
 #  3. Use `get_colors_by_time` to get the sunlight gradient for that day
 #  4. Choose the right colour for the previously selected time
 #  5. Plot the map
@@ -448,7 +516,7 @@ print(times[0], times[-1])
 def create_frame(step, ax):
     ax.cla()
     selected_time = times[step]
-    cycles_info = data_to_plot[data_to_plot["query_time"] == selected_time]
+    cycles_info = data_by_time[selected_time]
     colors = get_colors_by_time(selected_time)
     color = colors[selected_time]
 
@@ -470,23 +538,115 @@ show_figure(fig)
 # %% [markdown]
 # Great! It works. Then we can actually create the animation.
 #
-# Using an instance of `FuncAnimation` which receives:
+# *matplotlib* has `FuncAnimation` to do this, but it draws the frames one after the other, using a single core. Each frame is independent of the rest, so I can draw them in parallel, each core taking care of a part of the video, and then stitch the parts together with *ffmpeg*.
+#
+# The function `render_frames` receives a range of steps and the path of the part of the video it should create, and it creates its own figure and axes.
 #
-#  - `fig`, the figure it is supposed to be drawing on
-#  - `create_frame`, the function that does all the drawing
-#  - `frames`, which specifies how many frames our animation has. In this case, I want as many frames as the length of the `times` array)
-#  - `fargs`, a tuple of extra arguments to the `create_frame` function, I am passing the axes instance in here
+# Drawing the outline of the boroughs is the slowest part of a frame, and the only things that change from one frame to the next are the bike stations, the clock and the colour of the boroughs. So instead of calling `create_frame`, `render_frames` draws the background only twice: once with black boroughs and once with white ones. The colour of a pixel in the background changes linearly with the colour of the boroughs, so with those two versions *numpy* can calculate the background for any other colour, without drawing anything. Then, for each frame, it puts the background for the right colour in the canvas, updates the stations and the clock, and draws just those on top of it – a technique known as *blitting*. The stations and the clock are marked as `animated`, so that they are not part of the background.
 #
-# Lastly, I call `save` on the `animation` variable, render the animation into an *mp4* file, at 10 frames per second, as specified with the `fps` argument.
+# The pixels of each frame go straight to an *ffmpeg* process through a pipe, as raw RGBA values – the same thing *matplotlib*'s `FFMpegWriter` does, but without drawing the whole figure again for every frame. No images are written to disk, and *ffmpeg* encodes the frames into an *mp4* file, at 15 frames per second, as specified with the `-framerate` argument.
+#
+# I split the steps into one contiguous range per CPU core and hand them to a `multiprocessing` `Pool`. The pool uses the `fork` start method, so each worker starts as a copy of this notebook, with the data and the functions already in memory.
+#
+# Lastly, *ffmpeg*'s `concat` demuxer joins the parts into a single video; since all of them are encoded in the same way, it can copy them without encoding them again.
 
 # %% gist="create_animation.py"
-from matplotlib.animation import FuncAnimation
-
-fig, ax = get_fig_and_ax()
-
-animation = FuncAnimation(fig, create_frame, frames=len(times), fargs=(ax,))
+import math
+import os
+import subprocess
+from multiprocessing import get_context
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import to_rgba
+
+segments_path = Path("segments")
+segments_path.mkdir(exist_ok=True)
+
+
+def render_frames(steps, segment):
+    fig, ax = get_fig_and_ax()
+    canvas = FigureCanvasAgg(fig)
+    width, height = canvas.get_width_height()
+
+    boroughs = plot_background(ax, "#F4F6F7")
+    stations = plot_stations(ax, data_by_time[times[steps[0]]])
+    clock_texts = plot_clock(ax, times[steps[0]])
+    animated_artists = [stations, *clock_texts]
+    for artist in animated_artists:
+        artist.set_animated(True)
+
+    ffmpeg = subprocess.Popen(
+        [
+            "ffmpeg",
+            "-y",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgba",
+            "-s",
+            f"{width}x{height}",
+            "-framerate",
+            "15",
+            "-i",
+            "-",
+            "-vcodec",
+            "h264",
+            "-pix_fmt",
+            "yuv420p",
+            str(segment),
+        ],
+        stdin=subprocess.PIPE,
+    )
 
-animation.save("animation.mp4", fps=15)
+    # Draw the background with black and with white boroughs, the difference between both is how much
+    # each pixel changes with the colour of the boroughs. The maths is done with integers, scaled by 255
+    # (and rounded with the + 127), since black + difference <= 255 the results fit in 16 bits
+    boroughs.set_facecolor("black")
+    canvas.draw()
+    background = np.asarray(canvas.buffer_rgba()).astype(np.uint16)
+    boroughs.set_facecolor("white")
+    canvas.draw()
+    boroughs_mask = np.asarray(canvas.buffer_rgba()) - background
+    background = background * 255 + 127
+    composite = np.empty_like(background)
+
+    pixels = np.asarray(canvas.buffer_rgba())
+    for step in steps:
+        selected_time = times[step]
+        cycles_info = data_by_time[selected_time]
+        color = get_colors_by_time(selected_time)[selected_time]
+
+        np.multiply(boroughs_mask, np.round(np.array(to_rgba(color)) * 255).astype(np.uint16), out=composite)
+        composite += background
+        composite //= 255
+        pixels[:] = composite
+
+        stations.set_offsets(cycles_info[["lon", "lat"]].to_numpy())
+        stations.set_array(cycles_info["proportion"].to_numpy())
+        for clock_text, text in zip(clock_texts, get_clock_texts(selected_time)):
+            clock_text.set_text(text)
+        for artist in animated_artists:
+            ax.draw_artist(artist)
+
+        ffmpeg.stdin.write(canvas.buffer_rgba())
+
+    ffmpeg.stdin.close()
+    if ffmpeg.wait():
+        raise subprocess.CalledProcessError(ffmpeg.returncode, ffmpeg.args)
+
+
+chunk_size = math.ceil(len(times) / os.cpu_count())
+chunks = [range(start, min(start + chunk_size, len(times))) for start in range(0, len(times), chunk_size)]
+segments = [segments_path / f"{idx:03d}.mp4" for idx in range(len(chunks))]
+
+with get_context("fork").Pool() as pool:
+    pool.starmap(render_frames, zip(chunks, segments))
+
+segments_list = segments_path / "segments.txt"
+segments_list.write_text("".join(f"file '{segment.name}'\n" for segment in segments))
+
+subprocess.run(["ffmpeg", "-y", "-f", "concat", "-i", str(segments_list), "-c", "copy", "animation.mp4"], check=True)
 
 # %% [markdown]
 # If all went well, you should see a video playing below:
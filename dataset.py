@@ -10,17 +10,13 @@ execution_time = datetime.utcnow()
 csv_file = Path("data", f"{execution_time.strftime('%Y-%m-%d')}.csv")
 
 
-def get_number(additional_properties, key):
-    [nb] = [prop.value for prop in additional_properties if prop.key == key]
-    return int(nb)
-
-
 def get_stations(all_bike_points):
     data = []
     for place in all_bike_points:
-        bikes = get_number(place.additionalProperties, "NbBikes")
-        empty_docks = get_number(place.additionalProperties, "NbEmptyDocks")
-        docks = get_number(place.additionalProperties, "NbDocks")
+        properties = {prop.key: prop.value for prop in place.additionalProperties}
+        bikes = int(properties["NbBikes"])
+        empty_docks = int(properties["NbEmptyDocks"])
+        docks = int(properties["NbDocks"])
         data.append((execution_time.isoformat(), place.id, place.lat, place.lon, bikes, empty_docks, docks,))
 
     return data
@@ -30,13 +26,12 @@ headers = ["query_time", "place_id", "lat", "lon", "bikes", "empty_docks", "dock
 
 
 first_file_of_the_day = not csv_file.exists()
-with open(csv_file, "a") as w:
+with open(csv_file, "a", newline="", buffering=1 << 20) as w:
     writer = csv.writer(w)
     if first_file_of_the_day:
         writer.writerow(headers)
     bike_points = bike_point.all()
-    for station_row in get_stations(bike_points):
-        writer.writerow(station_row)
+    writer.writerows(get_stations(bike_points))
 
 
 if first_file_of_the_day:
@@ -54,8 +49,7 @@ if first_file_of_the_day:
         station_dict = {"common_name": bike_point.commonName, "place_id": bike_point.id, **props}
         properties.update(station_dict.keys())
         dictionaries.append(station_dict)
-    with open(information_file, "w") as w:
+    with open(information_file, "w", newline="", buffering=1 << 20) as w:
         writer = csv.DictWriter(w, fieldnames=list(set(properties)))
         writer.writeheader()
-        for dd in dictionaries:
-            writer.writerow(dd)
+        writer.writerows(dictionaries)
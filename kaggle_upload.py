@@ -1,5 +1,6 @@
 import json
 import os
+import re
 from datetime import date
 from glob import glob
 
@@ -15,6 +16,10 @@ schema_fields = [
     ("docks", "Number of total docks at the station", "number"),
 ]
 
+schema = [{"name": name, "description": description, "type": _type} for name, description, _type in schema_fields]
+
+data_file_pattern = re.compile(r"data/(\d{4})-(\d{2})-(\d{2})\.csv$")
+
 with open("dataset-metadata.json") as r:
     dataset_metadata = json.load(r)
 
@@ -26,13 +31,12 @@ today = date.today()
 
 
 for file in sorted(glob("data/*.csv")):
-    date_parts = file[5:-4].split("-")
-    if len(date_parts) == 4:
+    match = data_file_pattern.match(file)
+    if not match:
         print("Skipping stations info")
         continue
 
-    date_parts = [int(part) for part in date_parts]
-    file_date = date(*date_parts)
+    file_date = date(*[int(part) for part in match.groups()])
 
     if file_date >= today:
         print(f"Skipping {file}")
@@ -41,9 +45,6 @@ for file in sorted(glob("data/*.csv")):
 
     dates.append(file_date)
 
-    schema = []
-    for name, description, _type in schema_fields:
-        schema.append({"name": name, "description": description, "type": _type})
     resource = {
         "path": file[5:],
         "description": f"Station data for the {file_date.strftime('%B %d %Y')}",